@@ -1,50 +1,153 @@
 import argparse
-import json
+import glob
+import hashlib
 import os
-import urllib
-import urllib.request
+import re
 import requests
 import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+STEPIK_URL = 'https://stepik.org'
+API_URL = STEPIK_URL + '/api/'
+TOKEN_URL = STEPIK_URL + '/oauth2/token/'
+
+# Number of API requests in flight at once. Must not exceed the pool size of the session adapter.
+MAX_WORKERS = 8
+# Number of ids sent in one API query. Longer queries are rejected by Stepik.
+IDS_PER_REQUEST = 100
+# Status codes of "URI Too Long" and "Request Header Fields Too Large".
+TOO_LONG_STATUS_CODES = (414, 431)
+# How long API responses are reused between runs, in seconds. Only used when requests-cache is installed.
+CACHE_EXPIRE_AFTER = 3600
+# Videos are read in 1 MiB chunks. Timeouts are (connect, read) in seconds.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_TIMEOUT = (10, 60)
+# Minimal time between two redraws of the download status line, in seconds.
+PROGRESS_INTERVAL = 0.1
+
+# Link to a video in the chosen quality and a message to show if that quality was not available.
+VideoLink = namedtuple('VideoLink', ['url', 'msg'])
+
+# Returns the block of a step. Not every block has a 'video' key.
+get_block = itemgetter('block')
+
+
+def make_session():
+    """
+    Create a session that keeps connections to Stepik alive between API calls.
+    If requests-cache is installed, API responses are also cached on disk between runs.
+    """
+    if requests_cache is not None:
+        # Only API responses are stored. A video CDN's Cache-Control headers would override
+        # a per-url expiration, so videos and the OAuth token are kept out with filter_fn.
+        session = requests_cache.CachedSession('stepik_downloader', backend='sqlite', use_cache_dir=True,
+                                               cache_control=True, expire_after=CACHE_EXPIRE_AFTER,
+                                               filter_fn=lambda resp: resp.url.startswith(API_URL))
+    else:
+        session = requests.Session()
+    session.mount(STEPIK_URL, HTTPAdapter(pool_connections=1, pool_maxsize=32))
+    return session
+
 
-def get_course_page(api_url, token):
-    return json.loads(requests.get(api_url, headers={'Authorization': 'Bearer ' + token}).text)
+def get_course_page(api_url, session):
+    return json_loads(session.get(api_url).content)
+
+
+def get_resource_batch(api_resource, ids, session):
+    """
+    Fetch all pages of api_resource objects with the given ids in a single query.
+    If Stepik rejects the query as too long, the ids are split in halves until it is accepted.
+    """
+    api_url = API_URL + api_resource
+    objects = []
+    batches = [ids]
+    while batches:
+        batch = batches.pop()
+        page = 1
+        while True:
+            resp = session.get(api_url, params={'ids[]': batch, 'page': page})
+            if resp.status_code in TOO_LONG_STATUS_CODES and len(batch) > 1:
+                middle = len(batch) // 2
+                batches += [batch[middle:], batch[:middle]]
+                break
+            resp.raise_for_status()
+            data = json_loads(resp.content)
+            objects.extend(data[api_resource])
+            if not data['meta']['has_next']:
+                break
+            page += 1
+    return objects
+
+
+def get_resources(api_resource, ids, session):
+    """
+    Fetch api_resource objects by ids, IDS_PER_REQUEST ids per query and several queries at once.
+    ids may be any iterable. Objects are returned in the order of ids.
+    """
+    ids = iter(ids)
+    batches = list(iter(lambda: list(islice(ids, IDS_PER_REQUEST)), []))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        pages = executor.map(lambda batch: get_resource_batch(api_resource, batch, session), batches)
+        objects = {obj['id']: obj for obj in chain.from_iterable(pages)}
+    return [objects[obj_id] for obj_id in chain.from_iterable(batches)]
 
 
 def get_all_weeks(stepik_resp):
     return stepik_resp['courses'][0]['sections']
 
 
-def get_unit_list(section_list, token):
-    resp = [json.loads(requests.get('https://stepik.org/api/sections/' + str(arr),
-                                    headers={'Authorization': 'Bearer ' + token}).text)
-            for arr in section_list]
-    return [section['sections'][0]['units'] for section in resp]
+def get_unit_list(section_list, session):
+    return [section['units'] for section in get_resources('sections', section_list, session)]
 
 
-def get_steps_list(units_list, week, token):
-    data = [json.loads(requests.get('https://stepik.org/api/units/' + str(unit_id),
-                                    headers={'Authorization': 'Bearer ' + token}).text)
-            for unit_id in units_list[week - 1]]
-    lesson_lists = [elem['units'][0]['lesson'] for elem in data]
-    data = [json.loads(requests.get('https://stepik.org/api/lessons/' + str(lesson_id),
-                                    headers={'Authorization': 'Bearer ' + token}).text)['lessons'][0]['steps']
-            for lesson_id in lesson_lists]
-    return [item for sublist in data for item in sublist]
+def get_steps_list(units_list, session):
+    """
+    Return step ids for every week of units_list. Units and lessons of all weeks are fetched together.
+    """
+    units = get_resources('units', chain.from_iterable(units_list), session)
+    lessons = iter(get_resources('lessons', [unit['lesson'] for unit in units], session))
+    # Lessons come in the same order as units, so every week takes the next len(week_units) of them.
+    return [list(chain.from_iterable(lesson['steps'] for lesson in islice(lessons, len(week_units))))
+            for week_units in units_list]
 
 
-def get_only_video_steps(step_list, token):
+def get_only_video_steps(steps_list, session):
+    steps = iter(get_resources('steps', chain.from_iterable(steps_list), session))
     resp_list = list()
-    for s in step_list:
-        resp = json.loads(requests.get('https://stepik.org/api/steps/' + str(s),
-                                       headers={'Authorization': 'Bearer ' + token}).text)
-        if resp['steps'][0]['block']['video']:
-            resp_list.append(resp['steps'][0]['block'])
-    print('Only video:', len(resp_list))
+    for week_steps in steps_list:
+        week_videos = [block for block in map(get_block, islice(steps, len(week_steps))) if block.get('video')]
+        print('Only video:', len(week_videos))
+        resp_list.append(week_videos)
     return resp_list
 
 
+def positive_int(value):
+    """
+    argparse type for options that need a number of at least 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got {}'.format(value))
+    return number
+
+
 def parse_arguments():
     """
     Parse input arguments with help of argparse.
@@ -79,115 +182,276 @@ def parse_arguments():
                         help='output directory. Default is the current folder',
                         default='.')
 
+    parser.add_argument('-j', '--jobs',
+                        help='number of videos downloaded at the same time. Default is 4',
+                        type=positive_int,
+                        default=4)
+
+    parser.add_argument('--no_cache',
+                        help='ignore API responses cached by previous runs (needs requests-cache)',
+                        action='store_true')
+
     args = parser.parse_args()
 
     return args
 
-def reporthook(blocknum, blocksize, totalsize): # progressbar
-    readsofar = blocknum * blocksize
-    if totalsize > 0:
-        percent = readsofar * 1e2 / totalsize
-        s = "\r%5.1f%% %*d / %d" % (percent, len(str(totalsize)), readsofar, totalsize)
-        sys.stderr.write(s)
-        if readsofar >= totalsize: # near the end
-            sys.stderr.write("\n")
-    else: # total size is unknown
-        sys.stderr.write("read %d\n" % (readsofar,))
+class DownloadStatus:
+    """
+    Progress of all downloads on a single status line, with messages printed on their own lines above it.
+    The status line is redrawn at most once per PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.finished = 0
+        self.running = {}  # filename -> (readsofar, totalsize)
+        self.lock = threading.Lock()
+        self.last_update = 0.0
+        self.line_length = 0
+
+    def start(self, filename, text):
+        with self.lock:
+            self.running[filename] = (0, 0)
+            self._print(text)
+
+    def update(self, filename, readsofar, totalsize):
+        with self.lock:
+            self.running[filename] = (readsofar, totalsize)
+            now = time.monotonic()
+            if now - self.last_update >= PROGRESS_INTERVAL:
+                self.last_update = now
+                self._draw()
+
+    def finish(self, filename, text):
+        with self.lock:
+            self.running.pop(filename, None)
+            self.finished += 1
+            self._print(text)
+
+    def close(self):
+        with self.lock:
+            if self.line_length:
+                sys.stderr.write("\n")
+                self.line_length = 0
+
+    def _print(self, text):
+        # Wipe the status line, print the message in its place and draw the status line again below it.
+        sys.stderr.write("\r" + " " * self.line_length + "\r")
+        sys.stderr.flush()
+        print(text, flush=True)
+        self._draw()
+
+    def _draw(self):
+        readsofar = sum(read for read, _ in self.running.values())
+        line = f"{self.finished}/{self.count} videos done, {len(self.running)} downloading"
+        if self.running and all(total > 0 for _, total in self.running.values()):
+            totalsize = sum(total for _, total in self.running.values())
+            line += f", {readsofar * 1e2 / totalsize:5.1f}% {readsofar} / {totalsize}"
+        elif self.running: # total size of some file is unknown
+            line += f", read {readsofar}"
+        sys.stderr.write("\r" + line.ljust(self.line_length))
+        sys.stderr.flush()
+        self.line_length = len(line)
+
+
+class DownloadAborted(Exception):
+    pass
+
+
+def video_headers(offset):
+    """
+    Headers of a video request that starts at byte offset.
+    """
+    # Videos are served by other hosts, so the session's API token must not be sent with them.
+    headers = {'Authorization': None}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+    return headers
+
+
+def parse_content_range(resp):
+    """
+    Return (start, total) from the Content-Range header of resp. Missing or unknown values are None.
+    """
+    match = re.match(r'bytes (\d+|\*)(?:-\d+)?/(\d+|\*)$', resp.headers.get('content-range', ''))
+    if match is None:
+        return None, None
+    return tuple(int(value) if value != '*' else None for value in match.groups())
+
+
+def download_video(url, filename, session, status, stop_event):
+    """
+    Download a single video into a .part file and rename it once complete.
+    A .part file left by an earlier run for the same url is resumed with a Range request.
+    Stops early once stop_event is set, keeping the .part file for the next run.
+    """
+    # The url is part of the name, so a run with another quality never appends to this file.
+    part_filename = '{}.{}.part'.format(filename, hashlib.sha1(url.encode()).hexdigest()[:12])
+    readsofar = os.path.getsize(part_filename) if os.path.isfile(part_filename) else 0
+    try:
+        status.start(filename, ('Resuming file ' if readsofar else 'Downloading file ') + filename)
+        resp = session.get(url, headers=video_headers(readsofar), stream=True, timeout=DOWNLOAD_TIMEOUT)
+        start, total = parse_content_range(resp)
+        if resp.status_code == 416 and total == readsofar:
+            # An earlier run got the whole video but stopped before renaming the .part file.
+            resp.close()
+        else:
+            if resp.status_code == 416 or (resp.status_code == 206 and start != readsofar):
+                # The .part file cannot be continued, download the video from the start.
+                resp.close()
+                readsofar = 0
+                resp = session.get(url, headers=video_headers(0), stream=True, timeout=DOWNLOAD_TIMEOUT)
+            with resp:
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    # The server ignored the Range header and sends the whole file.
+                    readsofar = 0
+                contentlength = int(resp.headers.get('content-length', 0))
+                totalsize = readsofar + contentlength if contentlength else 0
+                with open(part_filename, 'ab' if readsofar else 'wb') as f:
+                    for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if stop_event.is_set():
+                            raise DownloadAborted
+                        f.write(chunk)
+                        readsofar += len(chunk)
+                        status.update(filename, readsofar, totalsize)
+        os.replace(part_filename, filename)
+        # Drop .part files left by runs that asked for another quality of this video.
+        for stale_filename in glob.glob(glob.escape(filename) + '.*.part'):
+            os.remove(stale_filename)
+        status.finish(filename, 'Done ' + filename)
+    except requests.exceptions.HTTPError:
+        if os.path.isfile(part_filename):
+            os.remove(part_filename)
+        status.finish(filename, 'Error while downloading. File {} deleted'.format(part_filename))
+    except requests.exceptions.RequestException:
+        status.finish(filename, 'Error while downloading. Run again to resume {}'.format(filename))
+    except DownloadAborted:
+        pass
+
+
+def download_videos(downloads, session, jobs):
+    """
+    Download (url, filename) pairs with at most `jobs` downloads running at the same time.
+    """
+    status = DownloadStatus(len(downloads))
+    stop_event = threading.Event()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(download_video, url, filename, session, status, stop_event)
+                       for url, filename in downloads]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Ctrl+C or a failed download (e.g. a full disk) stops everything instead of running the rest
+                # of the queue. Running downloads notice the event on their next chunk and stop, keeping
+                # their .part files.
+                stop_event.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    except KeyboardInterrupt:
+        status.close()
+        print('\nAborted')
+        exit(1)
+    finally:
+        status.close()
 
 def main():
     args = parse_arguments()
 
     """
     Example how to receive token from Stepik.org
-    Token should also been add to every request header
-    example: requests.get(api_url, headers={'Authorization': 'Bearer '+ token})
+    Token is added once to the session headers and sent with every request
     """
 
+    session = make_session()
+    if args.no_cache and requests_cache is not None:
+        session.cache.clear()
+
     auth = HTTPBasicAuth(args.client_id, args.client_secret)
-    resp = requests.post('https://stepik.org/oauth2/token/', data={'grant_type': 'client_credentials'}, auth=auth)
-    token = json.loads(resp.text)['access_token']
+    resp = session.post(TOKEN_URL, data={'grant_type': 'client_credentials'}, auth=auth)
+    token = json_loads(resp.content)['access_token']
+    session.headers['Authorization'] = f'Bearer {token}'
 
-    course_data = get_course_page('http://stepik.org/api/courses/' + args.course_id, token)
+    course_data = get_course_page(API_URL + 'courses/' + args.course_id, session)
 
     weeks_num = get_all_weeks(course_data)
 
-    all_units = get_unit_list(weeks_num, token)
-    # Loop through all week in a course and
-    # download all videos or
-    # download only for the week_id is passed as an argument.
-    for week in range(1, len(weeks_num)+1):
-        # Skip if week_id is passed as an argument
-        args_week_id = str(args.week_id)
-        if args_week_id != "None":
-            # week_id starts from 1 and week counts from 0!
-            if week != int(args_week_id):
-                continue
-
-        all_steps = get_steps_list(all_units, week, token)
-
-        only_video_steps = get_only_video_steps(all_steps, token)
+    all_units = get_unit_list(weeks_num, session)
 
+    # Download all videos or
+    # download only for the week_id is passed as an argument.
+    if args.week_id is None:
+        weeks = list(range(1, len(weeks_num)+1))
+    elif 1 <= args.week_id <= len(weeks_num):
+        weeks = [args.week_id]
+    else:
+        print("Week {} does not exist, the course has weeks 1 to {}".format(args.week_id, len(weeks_num)))
+        exit(1)
+
+    # week_id starts from 1 and week counts from 0!
+    all_steps = get_steps_list([all_units[week - 1] for week in weeks], session)
+
+    all_video_steps = get_only_video_steps(all_steps, session)
+
+    downloads = []
+    # Loop through the selected weeks in a course.
+    for week, only_video_steps in zip(weeks, all_video_steps):
         url_list_with_q = []
 
         # Loop through videos and store the url link and the quality.
         for video_step in only_video_steps:
-            video_link = None
             msg = None
 
             # Check a video quality.
-            for url in video_step['video']['urls']:
-                if url['quality'] == args.quality:
-                    video_link = url['url']
+            urls = video_step['video']['urls']
+            qualities = {url['quality']: url['url'] for url in urls}
+            video_link = qualities.get(args.quality)
 
             # If the is no required video quality then download
             # with the best available quality.
             if video_link is None:
                 msg = "The requested quality = {} is not available!".format(args.quality)
 
-                video_link = video_step['video']['urls'][0]['url']
+                video_link = urls[0]['url']
 
             # Store link and quality.
-            url_list_with_q.append({'url': video_link, 'msg': msg})
+            url_list_with_q.append(VideoLink(video_link, msg))
 
         # Compose a folder name.
         folder_name = os.path.join(args.output_dir, args.course_id, 'week_' + str(week))
 
-        # Create a folder if needed.
-        if not os.path.isdir(folder_name):
-            try:
-                # Create a directory for a particular week in the course.
-                os.makedirs(folder_name)
-            except PermissionError:
-                print("Run the script from admin")
-                exit(1)
-            except FileExistsError:
-                print("Please delete the folder " + folder_name)
-                exit(1)
+        # Create a directory for a particular week in the course if needed.
+        try:
+            os.makedirs(folder_name, exist_ok=True)
+        except PermissionError:
+            print("Run the script from admin")
+            exit(1)
+        except FileExistsError:
+            print("A file is in the way of the folder " + folder_name + ", please move or delete it")
+            exit(1)
 
         print('Folder_name ', folder_name)
 
-        for week, el in enumerate(url_list_with_q):
+        # Read the folder once instead of checking every video file separately.
+        existing_files = {entry.name for entry in os.scandir(folder_name) if entry.is_file()}
+
+        for video_num, el in enumerate(url_list_with_q):
             # Print a message if something wrong.
-            if el['msg']:
-                print("{}".format(el['msg']))
-
-            filename = os.path.join(folder_name, 'Video_' + str(week) + '.mp4')
-            if not os.path.isfile(filename):
-                try:
-                    print('Downloading file ', filename)
-                    urllib.request.urlretrieve(el['url'], filename, reporthook)
-                    print('Done')
-                except urllib.error.ContentTooShortError:
-                    os.remove(filename)
-                    print('Error while downloading. File {} deleted:'.format(filename))
-                except KeyboardInterrupt:
-                    if os.path.isfile(filename):
-                        os.remove(filename)
-                    print('\nAborted')
-                    exit(1)
+            if el.msg:
+                print("{}".format(el.msg))
+
+            basename = 'Video_' + str(video_num) + '.mp4'
+            filename = os.path.join(folder_name, basename)
+            if basename not in existing_files:
+                downloads.append((el.url, filename))
             else:
                 print('File {} already exist'.format(filename))
-        print("All steps downloaded")
+
+    download_videos(downloads, session, args.jobs)
+    print("All steps downloaded")
 
 
 if __name__ == "__main__":